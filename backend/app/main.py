@@ -1,11 +1,27 @@
 import os
+
+# Configure the CUDA caching allocator before torch is imported. Expandable
+# segments avoid fragmentation OOMs on long-running servers.
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
+# Keep compiled encoder kernels next to the checkpoints so restarts can reuse them
+os.environ.setdefault(
+    "TORCHINDUCTOR_CACHE_DIR",
+    os.path.abspath(os.path.join(os.environ.get("CHECKPOINTS_DIR", "./checkpoints"), "inductor_cache"))
+)
+
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
 import logging
 
 from app.routers import segmentation
 from app.models.sam_model import SAM_MODELS, get_model
+from app.models.inference_queue import get_inference_queue
+from app.models.image_store import get_image_store
 
 # Configure logging
 logging.basicConfig(
@@ -14,11 +30,43 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Seconds between sweeps for images that have expired
+IMAGE_SWEEP_INTERVAL = float(os.environ.get('IMAGE_SWEEP_INTERVAL', 60))
+
+async def sweep_expired_images(image_store, model):
+    """Periodically remove idle images, their files and cached embeddings."""
+    while True:
+        await asyncio.sleep(IMAGE_SWEEP_INTERVAL)
+        await segmentation.remove_expired_images(image_store, model)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load the SAM model once at startup so the first request doesn't pay for it."""
+    logger.info("Loading SAM model at startup")
+    model = await asyncio.to_thread(get_model)
+    
+    # Check the image store now, so a misconfigured Redis fails startup
+    image_store = get_image_store()
+    await image_store.ping()
+    
+    # Start the worker that serializes inference requests
+    inference_queue = get_inference_queue()
+    inference_queue.start()
+    sweeper = asyncio.create_task(sweep_expired_images(image_store, model))
+    yield
+    sweeper.cancel()
+    try:
+        await sweeper
+    except asyncio.CancelledError:
+        pass
+    await inference_queue.stop()
+
 # Create FastAPI app
 app = FastAPI(
     title="Image Clipper API",
     description="API for image segmentation and mask extraction",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 # Configure CORS
@@ -30,6 +78,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress larger responses such as segmentation results; low effort keeps
+# already-compressed exports cheap
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=1)
+
 # Include routers
 app.include_router(segmentation.router, prefix="/api/v1", tags=["segmentation"])
 
@@ -55,11 +107,8 @@ async def get_available_models():
     # Get the current model instance
     model = get_model()
     
-    # Get the current model type from environment
-    current_model_type = os.environ.get('SAM_MODEL_TYPE', 'vit_b')
-    
     return {
         "available_models": SAM_MODELS,
-        "current_model": current_model_type,
+        "current_model": model.model_type,
         "device": str(model.device)
     } 
\ No newline at end of file
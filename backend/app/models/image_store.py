@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+class ImageStore:
+    """
+    Metadata and segmentation results for uploaded images, keyed by image ID.
+
+    Entries live in process memory, which only works with a single server
+    process. Use RedisImageStore so several workers share the same images.
+    Each read or write records the access time so idle entries can expire.
+    Methods are coroutines so the Redis store never blocks the event loop.
+    """
+
+    def __init__(self, ttl: float = 1800):
+        self.ttl = ttl
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._last_access: Dict[str, float] = {}
+
+    async def ping(self):
+        """Check that the store is reachable."""
+
+    async def get(self, image_id: str, fields: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        """
+        Return the entry for image_id, or None if it doesn't exist.
+
+        Args:
+            image_id: ID of the image
+            fields: Only return these fields, to avoid loading large ones such as masks
+        """
+        data = self._entries.get(image_id)
+        if data is None:
+            return None
+        self._last_access[image_id] = time.monotonic()
+        if fields is not None:
+            return {field: data.get(field) for field in fields}
+        return data
+
+    async def set(self, image_id: str, data: Dict[str, Any]):
+        """Create or replace the entry for image_id."""
+        self._entries[image_id] = data
+        self._last_access[image_id] = time.monotonic()
+
+    async def update(self, image_id: str, **fields):
+        """Update fields of an existing entry."""
+        data = self._entries.get(image_id)
+        if data is None:
+            raise KeyError(image_id)
+        data.update(fields)
+        self._last_access[image_id] = time.monotonic()
+
+    async def delete(self, image_id: str) -> Optional[Dict[str, Any]]:
+        """Remove the entry for image_id and return it."""
+        self._last_access.pop(image_id, None)
+        return self._entries.pop(image_id, None)
+
+    async def has_hash(self, image_hash: str) -> bool:
+        """Whether any stored image has the given content hash."""
+        return any(data["image_hash"] == image_hash for data in self._entries.values())
+
+    async def stored_hashes(self, image_hashes: Iterable[str]) -> Set[str]:
+        """The given content hashes that some stored image still has."""
+        stored = {data["image_hash"] for data in self._entries.values()}
+        return stored.intersection(image_hashes)
+
+    async def expired(self) -> List[str]:
+        """IDs of entries that haven't been accessed within the TTL."""
+        cutoff = time.monotonic() - self.ttl
+        return [image_id for image_id, accessed in self._last_access.items() if accessed < cutoff]
+
+# Sets fields of an existing entry and records the access in one atomic step,
+# so concurrent updates of different fields never overwrite each other
+_UPDATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+redis.call('ZADD', KEYS[2], ARGV[1], ARGV[2])
+return 1
+"""
+
+class RedisImageStore(ImageStore):
+    """
+    Image store backed by Redis, shared by every server process.
+
+    Each entry is a Redis hash with one JSON-encoded field per entry field,
+    so updates only touch the fields they change and reads can skip large
+    fields. Masks are already compact run-length strings. Nothing is cached
+    in process, since another worker may update an entry. Access times are
+    kept in a sorted set shared by all workers, so the expiry sweep also
+    removes the files behind idle entries rather than letting Redis drop
+    the entries on its own.
+    """
+
+    def __init__(self, url: str, prefix: str = "image-clipper", ttl: float = 1800):
+        import redis.asyncio
+
+        self.ttl = ttl
+        self._redis = redis.asyncio.Redis.from_url(url)
+        self._prefix = prefix
+        self._access_key = f"{prefix}:access"
+        self._update_script = self._redis.register_script(_UPDATE_SCRIPT)
+
+    def _key(self, image_id: str) -> str:
+        return f"{self._prefix}:image:{image_id}"
+
+    def _hash_key(self, image_hash: str) -> str:
+        return f"{self._prefix}:hash:{image_hash}"
+
+    async def ping(self):
+        await self._redis.ping()
+
+    async def get(self, image_id: str, fields: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        # Refresh the access time in the same round trip; XX never adds an ID
+        # for a missing entry. Workers on other hosts share the access times,
+        # so use wall-clock time
+        pipeline = self._redis.pipeline(transaction=False)
+        if fields is None:
+            pipeline.hgetall(self._key(image_id))
+        else:
+            pipeline.hmget(self._key(image_id), fields)
+        pipeline.zadd(self._access_key, {image_id: time.time()}, xx=True)
+        values, _ = await pipeline.execute()
+
+        if fields is None:
+            if not values:
+                return None
+            return {field.decode(): json.loads(value) for field, value in values.items()}
+        if all(value is None for value in values):
+            return None
+        return {field: json.loads(value) if value is not None else None for field, value in zip(fields, values)}
+
+    async def set(self, image_id: str, data: Dict[str, Any]):
+        pipeline = self._redis.pipeline()
+        pipeline.delete(self._key(image_id))
+        pipeline.hset(self._key(image_id), mapping={field: json.dumps(value) for field, value in data.items()})
+        pipeline.zadd(self._access_key, {image_id: time.time()})
+        pipeline.sadd(self._hash_key(data["image_hash"]), image_id)
+        await pipeline.execute()
+
+    async def update(self, image_id: str, **fields):
+        args = [time.time(), image_id]
+        for field, value in fields.items():
+            args.extend([field, json.dumps(value)])
+        if not await self._update_script(keys=[self._key(image_id), self._access_key], args=args):
+            raise KeyError(image_id)
+
+    async def delete(self, image_id: str) -> Optional[Dict[str, Any]]:
+        fields = await self._redis.hgetall(self._key(image_id))
+        data = {field.decode(): json.loads(value) for field, value in fields.items()} if fields else None
+        pipeline = self._redis.pipeline()
+        pipeline.delete(self._key(image_id))
+        pipeline.zrem(self._access_key, image_id)
+        if data is not None:
+            pipeline.srem(self._hash_key(data["image_hash"]), image_id)
+        deleted = (await pipeline.execute())[0]
+
+        # Another worker may have deleted the entry first
+        return data if deleted else None
+
+    async def has_hash(self, image_hash: str) -> bool:
+        return await self._redis.scard(self._hash_key(image_hash)) > 0
+
+    async def stored_hashes(self, image_hashes: Iterable[str]) -> Set[str]:
+        image_hashes = list(image_hashes)
+        pipeline = self._redis.pipeline(transaction=False)
+        for image_hash in image_hashes:
+            pipeline.scard(self._hash_key(image_hash))
+        counts = await pipeline.execute()
+        return {image_hash for image_hash, count in zip(image_hashes, counts) if count > 0}
+
+    async def expired(self) -> List[str]:
+        cutoff = time.time() - self.ttl
+        return [image_id.decode() for image_id in await self._redis.zrangebyscore(self._access_key, "-inf", cutoff)]
+
+# Singleton instance
+_store_instance = None
+
+def get_image_store() -> ImageStore:
+    """
+    Get or create the image store, using Redis when REDIS_URL is set.
+
+    The lifespan pings the store at startup, so failing to reach Redis is an
+    error rather than a fallback: workers with separate in-memory stores
+    would lose each other's images.
+    """
+    global _store_instance
+    if _store_instance is None:
+        ttl = float(os.environ.get('IMAGE_TTL_SECONDS', 1800))
+        redis_url = os.environ.get('REDIS_URL')
+        if redis_url:
+            _store_instance = RedisImageStore(redis_url, ttl=ttl)
+            logger.info("Using Redis image store")
+        else:
+            _store_instance = ImageStore(ttl=ttl)
+    return _store_instance
@@ -0,0 +1,78 @@
+import os
+import asyncio
+import logging
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+class InferenceQueue:
+    """
+    Run model work one job at a time on a single background worker.
+
+    The SAM predictor keeps per-image state and the device can only hold one
+    image encoder pass at a time, so concurrent requests are queued here
+    instead of racing into `set_image`.
+    """
+
+    def __init__(self, maxsize: int = 16):
+        self.maxsize = maxsize
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start the worker task on the running event loop."""
+        if self._worker is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._worker = asyncio.create_task(self._run())
+        logger.info(f"Inference worker started (queue size {self.maxsize})")
+
+    async def stop(self):
+        """Cancel the worker task."""
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        self._queue = None
+        logger.info("Inference worker stopped")
+
+    async def submit(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Queue a blocking call for the worker and wait for its result."""
+        if self._queue is None:
+            raise RuntimeError("Inference queue not started")
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((future, func, args, kwargs))
+        return await future
+
+    async def _run(self):
+        while True:
+            future, func, args, kwargs = await self._queue.get()
+            try:
+                # The caller may have gone away while the job was queued
+                if future.cancelled():
+                    continue
+
+                # Run the blocking work in a thread so the event loop stays responsive
+                result = await asyncio.to_thread(func, *args, **kwargs)
+                if not future.cancelled():
+                    future.set_result(result)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+# Singleton instance
+_queue_instance = None
+
+def get_inference_queue() -> InferenceQueue:
+    """Get or create the inference queue instance."""
+    global _queue_instance
+    if _queue_instance is None:
+        _queue_instance = InferenceQueue(maxsize=int(os.environ.get('INFERENCE_QUEUE_SIZE', 16)))
+    return _queue_instance
@@ -0,0 +1,90 @@
+import os
+import logging
+import tempfile
+import torch
+from typing import Any, Dict, List, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# Preferred execution providers, fastest first
+ONNX_PROVIDERS = [
+    "TensorrtExecutionProvider",
+    "CUDAExecutionProvider",
+    "CPUExecutionProvider"
+]
+
+class OnnxImageEncoder(torch.nn.Module):
+    """
+    Drop-in replacement for SAM's image encoder backed by ONNX Runtime.
+
+    The PyTorch encoder is exported to ONNX once and cached on disk. The mask
+    decoder stays in PyTorch, so this module only has to map the preprocessed
+    image batch to image embeddings on the model's device.
+    """
+
+    def __init__(self, encoder: torch.nn.Module, onnx_path: str, device: torch.device):
+        super().__init__()
+        import onnxruntime as ort
+
+        self.img_size = encoder.img_size
+        self.device = device
+
+        if not os.path.exists(onnx_path):
+            self._export(encoder, onnx_path)
+
+        providers = self._providers(ort.get_available_providers(), onnx_path)
+        self.session = ort.InferenceSession(onnx_path, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+        logger.info(f"ONNX image encoder loaded with providers: {self.session.get_providers()}")
+
+    def _providers(self, available: List[str], onnx_path: str) -> List[Union[str, Tuple[str, Dict[str, Any]]]]:
+        """Pick the usable execution providers, skipping GPU ones on CPU."""
+        if self.device.type != 'cuda':
+            return ["CPUExecutionProvider"]
+
+        providers = []
+        for provider in ONNX_PROVIDERS:
+            if provider not in available:
+                continue
+            if provider == "TensorrtExecutionProvider":
+                # Build a reduced-precision engine once and cache it next to the ONNX file,
+                # since building takes minutes
+                provider = (provider, {
+                    "trt_fp16_enable": os.environ.get('SAM_TRT_FP16', 'true').lower() == 'true',
+                    "trt_engine_cache_enable": True,
+                    "trt_engine_cache_path": os.path.dirname(os.path.abspath(onnx_path))
+                })
+            providers.append(provider)
+        return providers
+
+    def _export(self, encoder: torch.nn.Module, onnx_path: str):
+        """Export the encoder for its fixed input size, writing via a temporary file."""
+        logger.info(f"Exporting image encoder to {onnx_path}")
+        os.makedirs(os.path.dirname(onnx_path) or ".", exist_ok=True)
+
+        device = next(encoder.parameters()).device
+        dummy = torch.zeros(1, 3, self.img_size, self.img_size, device=device)
+        
+        # Each worker exports to its own temporary file, so workers starting
+        # together don't collide
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(onnx_path) or ".")
+        os.close(fd)
+        try:
+            with torch.no_grad():
+                torch.onnx.export(
+                    encoder,
+                    dummy,
+                    temp_path,
+                    opset_version=17,
+                    input_names=["image"],
+                    output_names=["image_embeddings"]
+                )
+            os.replace(temp_path, onnx_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        image = x.float().cpu().numpy()
+        embeddings = self.session.run(None, {self.input_name: image})[0]
+        return torch.from_numpy(embeddings).to(self.device)
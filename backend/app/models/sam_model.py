@@ -1,17 +1,58 @@
 import os
 import torch
+import torch.nn.functional as F
 import numpy as np
 from segment_anything import sam_model_registry, SamPredictor
+from segment_anything.utils.transforms import ResizeLongestSide
+from segment_anything.utils.amg import batched_mask_to_box, calculate_stability_score
+from torchvision.ops.boxes import batched_nms
 import logging
 import cv2
-from typing import List, Tuple, Dict, Any, Optional
+from typing import List, Tuple, Dict, Any, Iterator, Optional
 import requests
 import urllib.request
 import tempfile
 import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from app.utils.image_utils import encode_rle
+
+# MobileSAM is optional; it is only needed for SAM_MODEL_TYPE=mobile
+try:
+    from mobile_sam import sam_model_registry as mobile_sam_model_registry
+    from mobile_sam import SamPredictor as MobileSamPredictor
+except ImportError:
+    mobile_sam_model_registry = None
+    MobileSamPredictor = None
+
+# safetensors is optional; without it checkpoints are loaded with torch.load
+try:
+    from safetensors import safe_open
+    from safetensors.torch import load_file as safetensors_load_file
+    from safetensors.torch import save_file as safetensors_save_file
+except ImportError:
+    safe_open = None
+    safetensors_load_file = None
+    safetensors_save_file = None
 
 logger = logging.getLogger(__name__)
 
+# Thread pool for per-mask postprocessing
+_mask_pool = ThreadPoolExecutor(max_workers=4)
+
+# Upper bound on the pixels upsampled at once when producing grid masks,
+# so memory use doesn't grow with the image size
+GRID_UPSAMPLE_PIXELS = 256 * 1024 * 1024
+
+# Supported values for SAM_DTYPE
+SAM_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16
+}
+
 # Available SAM model checkpoints
 SAM_MODELS = {
     "vit_h": {
@@ -27,19 +68,171 @@ SAM_MODELS = {
     "vit_b": {
         "url": "https://dl.fbaipublicfiles.com/segment_anything/sam_vit_b_01ec64.pth",
         "size": "375MB",
-        "description": "ViT-B SAM model (smallest, fastest)"
+        "description": "ViT-B SAM model (smallest SAM, faster)"
+    },
+    "mobile": {
+        "url": "https://raw.githubusercontent.com/ChaoningZhang/MobileSAM/master/weights/mobile_sam.pt",
+        "size": "39MB",
+        "description": "MobileSAM TinyViT model (fastest, requires the mobile_sam package)"
     }
 }
 
+def _encode_mask(index: int, mask: np.ndarray, score: float) -> Optional[Dict[str, Any]]:
+    """Convert a predicted mask into a serializable mask record, or None if it is empty."""
+    # Find bounding box for the mask from its occupied rows and columns,
+    # rather than allocating index arrays for every foreground pixel
+    rows = mask.any(axis=1)
+    if not rows.any():
+        return None
+        
+    y_min = int(rows.argmax())
+    y_max = len(rows) - 1 - int(rows[::-1].argmax())
+    
+    # Only the occupied rows need scanning for columns and area
+    band = mask[y_min:y_max + 1]
+    cols = band.any(axis=0)
+    x_min = int(cols.argmax())
+    x_max = len(cols) - 1 - int(cols[::-1].argmax())
+    width, height = x_max - x_min, y_max - y_min
+    
+    # Calculate area of the mask
+    area = int(np.count_nonzero(band))
+    
+    return {
+        "id": index,
+        "score": float(score),
+        "bbox": [x_min, y_min, width, height],
+        "rle": encode_rle(mask),
+        "area": area
+    }
+
+def _encode_masks(masks: np.ndarray, scores: np.ndarray, start: int = 0) -> List[Dict[str, Any]]:
+    """Convert predicted masks into serializable mask records numbered from start, skipping empty masks."""
+    # Masks are independent and NumPy releases the GIL on large arrays,
+    # so encoding them in parallel overlaps most of the work
+    indices = range(start, start + len(masks))
+    records = _mask_pool.map(_encode_mask, indices, masks, scores)
+    return [record for record in records if record is not None]
+
+def _prompt_arrays(
+    points: Optional[List[List[int]]],
+    point_labels: Optional[List[int]],
+    box: Optional[List[int]]
+) -> Tuple[Optional[np.ndarray], Optional[np.ndarray], Optional[np.ndarray]]:
+    """Convert request prompts into NumPy arrays, validating their shapes."""
+    point_coords = None
+    if points is not None:
+        point_coords = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        
+    point_labels_array = None
+    if point_labels is not None:
+        point_labels_array = np.asarray(point_labels, dtype=np.int32).reshape(-1)
+        if point_coords is not None and len(point_labels_array) != len(point_coords):
+            raise ValueError("points and point_labels must have the same length")
+    elif point_coords is not None:
+        raise ValueError("point_labels are required with points")
+            
+    box_array = None
+    if box is not None:
+        box_array = np.asarray(box, dtype=np.float32).reshape(4)
+        
+    return point_coords, point_labels_array, box_array
+
+class EmbeddingCache:
+    """
+    Small LRU cache of SAM image embeddings keyed by image content hash.
+    
+    Running the image encoder is by far the most expensive step, so repeated
+    prompts on the same image restore the cached predictor state instead.
+    The inference worker fills the cache while request handlers check it
+    and evict from it on the event loop, so access is guarded by a lock.
+    """
+    
+    def __init__(self, max_entries: int = 8):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+        
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached entry for key and mark it as recently used."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+        
+    def put(self, key: str, entry: Dict[str, Any]):
+        """Store an entry, evicting the least recently used one if full."""
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            
+    def pop(self, key: str) -> Optional[Dict[str, Any]]:
+        """Remove an entry from the cache."""
+        with self._lock:
+            return self._entries.pop(key, None)
+        
+    def keys(self) -> List[str]:
+        """Keys of the cached entries, least recently used first."""
+        with self._lock:
+            return list(self._entries)
+
 class SAMModel:
     def __init__(self):
         self.predictor = None
+        self.model_type = None
+        self.image_size = None
+        self._staging = None
+        self._input_buffer = None
+        self._staging_done = None
+        self._cuda_graphs = False
+        self.embedding_cache = EmbeddingCache(
+            max_entries=int(os.environ.get('EMBEDDING_CACHE_SIZE', 8))
+        )
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         logger.info(f"Using device: {self.device}")
+        self.dtype = self._resolve_dtype()
+        logger.info(f"Using inference dtype: {self.dtype}")
         
+        if self.device.type == 'cuda':
+            # Let float32 matmuls use TF32 tensor cores, and let cuDNN pick the
+            # fastest kernels for SAM's fixed input shape
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.benchmark = True
+            
         # Load model
         self._load_model()
         
+    def _resolve_dtype(self) -> torch.dtype:
+        """Pick the autocast dtype from SAM_DTYPE, defaulting to float16 on CUDA."""
+        default_dtype = "float16" if self.device.type == 'cuda' else "float32"
+        dtype_name = os.environ.get('SAM_DTYPE', default_dtype)
+        
+        if dtype_name not in SAM_DTYPES:
+            logger.warning(f"Invalid dtype: {dtype_name}. Falling back to {default_dtype}.")
+            dtype_name = default_dtype
+            
+        # CPU autocast only supports bfloat16
+        if self.device.type == 'cpu' and dtype_name == "float16":
+            logger.warning("float16 is not supported on CPU. Falling back to bfloat16.")
+            dtype_name = "bfloat16"
+            
+        return SAM_DTYPES[dtype_name]
+        
+    def _autocast(self):
+        """Autocast context for the image encoder; a no-op in float32."""
+        return torch.autocast(
+            device_type=self.device.type,
+            dtype=self.dtype,
+            enabled=self.dtype != torch.float32
+        )
+        
     def _load_model(self):
         """Load the SAM model."""
         try:
@@ -51,12 +244,16 @@ class SAMModel:
             if model_type not in SAM_MODELS:
                 logger.warning(f"Invalid model type: {model_type}. Falling back to vit_b.")
                 model_type = "vit_b"
+            elif model_type == "mobile" and mobile_sam_model_registry is None:
+                logger.warning("mobile_sam is not installed. Falling back to vit_b.")
+                model_type = "vit_b"
                 
             # Get model info
             model_info = SAM_MODELS[model_type]
             model_filename = os.path.basename(model_info["url"])
             model_path = os.path.join(checkpoints_dir, model_filename)
             
+            self.model_type = model_type
             logger.info(f"Using SAM model: {model_type} ({model_info['description']})")
             logger.info(f"Model path: {model_path}")
             
@@ -65,18 +262,121 @@ class SAMModel:
                 logger.info(f"Model checkpoint not found. Downloading {model_type} model ({model_info['size']})...")
                 self._download_model(model_info["url"], model_path)
             
-            # Initialize the SAM model
-            sam = sam_model_registry[model_type](checkpoint=model_path)
-            sam.to(device=self.device)
+            # Initialize the SAM model; MobileSAM registers its TinyViT encoder as vit_t
+            if model_type == "mobile":
+                build_sam = mobile_sam_model_registry["vit_t"]
+                predictor_class = MobileSamPredictor
+            else:
+                build_sam = sam_model_registry[model_type]
+                predictor_class = SamPredictor
+            sam = self._build_sam(build_sam, model_path)
+            
+            # The encoder input arrives as an HWC buffer viewed as NCHW, which is already
+            # channels_last; match the conv weights so cuDNN picks the NHWC kernels
+            if self.device.type == 'cuda':
+                sam.image_encoder.to(memory_format=torch.channels_last)
             
             # Create the predictor
-            self.predictor = SamPredictor(sam)
+            self.predictor = predictor_class(sam)
+            self.image_size = sam.image_encoder.img_size
+            
+            # Reusable pinned host buffer and device buffer for the resized input image,
+            # allocated once at full encoder size so requests don't fragment the allocator
+            if self.device.type == 'cuda':
+                img_size = sam.image_encoder.img_size
+                self._staging = torch.empty(img_size * img_size * 3, dtype=torch.uint8, pin_memory=True)
+                self._input_buffer = torch.empty(img_size * img_size * 3, dtype=torch.uint8, device=self.device)
+                
+            # Run the image encoder through ONNX Runtime if requested, otherwise
+            # compile it for fused kernels, unless disabled
+            if os.environ.get('SAM_ENCODER_BACKEND', 'torch').lower() == 'onnx':
+                onnx_path = os.path.join(checkpoints_dir, f"{os.path.splitext(model_filename)[0]}_encoder.onnx")
+                self._use_onnx_encoder(onnx_path)
+            elif self.device.type == 'cuda' and os.environ.get('SAM_COMPILE', 'true').lower() == 'true':
+                self._compile_encoder()
             logger.info(f"SAM model {model_type} loaded successfully")
             
         except Exception as e:
             logger.error(f"Error loading SAM model: {e}")
             raise
     
+    def _build_sam(self, build_sam, model_path: str) -> torch.nn.Module:
+        """
+        Build the SAM model on the device, preferring a safetensors copy of the checkpoint.
+        
+        safetensors memory-maps the weights and loads them straight onto the
+        device, skipping the pickle pass and the full in-memory copy of
+        torch.load. The copy is written next to the checkpoint on first load,
+        and rebuilt when the checkpoint's size or modification time changes.
+        """
+        if safetensors_load_file is None:
+            return build_sam(checkpoint=model_path).to(device=self.device)
+            
+        safetensors_path = f"{os.path.splitext(model_path)[0]}.safetensors"
+        stat = os.stat(model_path)
+        source = {"source_size": str(stat.st_size), "source_mtime_ns": str(stat.st_mtime_ns)}
+        if os.path.exists(safetensors_path):
+            with safe_open(safetensors_path, framework="pt") as f:
+                metadata = f.metadata() or {}
+            if all(metadata.get(key) == value for key, value in source.items()):
+                logger.info(f"Loading weights from {safetensors_path}")
+                sam = build_sam(checkpoint=None).to(device=self.device)
+                sam.load_state_dict(safetensors_load_file(safetensors_path, device=str(self.device)))
+                return sam
+            logger.info(f"Checkpoint changed since {safetensors_path} was written, rebuilding it")
+            
+        sam = build_sam(checkpoint=model_path)
+        
+        # Each worker writes its own temporary file, so workers starting together
+        # don't collide; the last rename wins with identical contents
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(safetensors_path) or ".")
+        os.close(fd)
+        try:
+            safetensors_save_file(sam.state_dict(), temp_path, metadata=source)
+            os.replace(temp_path, safetensors_path)
+            logger.info(f"Saved safetensors weights to {safetensors_path}")
+        except Exception as e:
+            logger.warning(f"Failed to save safetensors weights: {e}")
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return sam.to(device=self.device)
+    
+    def _use_onnx_encoder(self, onnx_path: str):
+        """Swap the image encoder for an ONNX Runtime session, keeping PyTorch on failure."""
+        sam = self.predictor.model
+        try:
+            from app.models.onnx_encoder import OnnxImageEncoder
+            sam.image_encoder = OnnxImageEncoder(sam.image_encoder, onnx_path, self.device)
+        except Exception as e:
+            logger.warning(f"Failed to load ONNX image encoder, using PyTorch: {e}")
+    
+    def _compile_encoder(self):
+        """Compile the image encoder with torch.compile, falling back to eager on failure."""
+        sam = self.predictor.model
+        eager_encoder = sam.image_encoder
+        try:
+            # The encoder input is always padded to the same size, so CUDA graphs apply
+            # and there is only one static shape to compile
+            sam.image_encoder = torch.compile(eager_encoder, mode="reduce-overhead", dynamic=False)
+            
+            self._cuda_graphs = True
+            
+            # Compile now with a dummy image rather than on the first request,
+            # under inference mode, as requests are, so the compiled graph is reused.
+            # The first call runs a warm-up and the second records the CUDA graph
+            img_size = eager_encoder.img_size
+            with torch.inference_mode():
+                for _ in range(2):
+                    self._encode_image(np.zeros((img_size, img_size, 3), dtype=np.uint8), (img_size, img_size))
+            self.predictor.reset_image()
+            logger.info("SAM image encoder compiled")
+        except Exception as e:
+            logger.warning(f"Failed to compile image encoder, using eager mode: {e}")
+            sam.image_encoder = eager_encoder
+            self._cuda_graphs = False
+            self.predictor.reset_image()
+    
     def _download_model(self, url: str, destination: str):
         """Download the model from the given URL to the destination path."""
         try:
@@ -118,20 +418,280 @@ class SAMModel:
                 os.unlink(temp_file.name)
             raise
 
-    def set_image(self, image: np.ndarray):
-        """Set the image for segmentation."""
+    def _resize_longest_side(self, image: np.ndarray) -> np.ndarray:
+        """Resize the image to the encoder's input size, matching SAM's ResizeLongestSide."""
+        target_length = self.predictor.transform.target_length
+        height, width = image.shape[:2]
+        new_height, new_width = ResizeLongestSide.get_preprocess_shape(height, width, target_length)
+        if (new_height, new_width) == (height, width):
+            return np.ascontiguousarray(image)
+            
+        # OpenCV's SIMD area filter is much faster than PIL for large downscales
+        interpolation = cv2.INTER_AREA if new_height < height else cv2.INTER_LINEAR
+        return cv2.resize(image, (new_width, new_height), interpolation=interpolation)
+        
+    def _encode_image(self, image: np.ndarray, original_size: Tuple[int, int]):
+        """Resize an HWC uint8 image, move it to the device and run the image encoder."""
+        input_image = self._resize_longest_side(image)
+        height, width = input_image.shape[:2]
+        input_tensor = torch.from_numpy(input_image)
+        
+        if self._staging is not None:
+            # Copy through the pinned buffer so the host-to-device transfer is asynchronous,
+            # landing in the preallocated device buffer instead of a fresh allocation
+            size = height * width * 3
+            staging = self._staging[:size].view(height, width, 3)
+            
+            # The previous image's transfer may still be queued behind the encoder;
+            # wait for it before overwriting the staging buffer
+            if self._staging_done is not None:
+                self._staging_done.synchronize()
+            staging.copy_(input_tensor)
+            input_tensor = self._input_buffer[:size].view(height, width, 3)
+            input_tensor.copy_(staging, non_blocking=True)
+            self._staging_done = torch.cuda.Event()
+            self._staging_done.record()
+            
+            # SAM's preprocessing accepts the strided CHW view directly
+            input_tensor = input_tensor.permute(2, 0, 1)[None, :, :, :]
+        else:
+            input_tensor = input_tensor.to(self.device)
+            input_tensor = input_tensor.permute(2, 0, 1).contiguous()[None, :, :, :]
+        with self._autocast():
+            self.predictor.set_torch_image(input_tensor, original_size)
+            
+        # The compiled encoder replays a CUDA graph whose output buffer is overwritten
+        # by the next image, so keep a copy of the embedding that can be cached
+        if self._cuda_graphs:
+            self.predictor.features = self.predictor.features.clone()
+        
+    @torch.inference_mode()
+    def restore_image(self, cache_key: str) -> bool:
+        """
+        Restore the predictor state for a cached image without running the encoder.
+        
+        Returns:
+            True if the embedding was cached, False otherwise
+        """
         if self.predictor is None:
             raise RuntimeError("Model predictor not initialized")
             
-        self.predictor.set_image(image)
+        entry = self.embedding_cache.get(cache_key)
+        if entry is None:
+            return False
+            
+        # Embeddings offloaded by release_image are moved back to the device
+        entry["features"] = entry["features"].to(self.device)
+        self.predictor.features = entry["features"]
+        self.predictor.original_size = entry["original_size"]
+        self.predictor.input_size = entry["input_size"]
+        self.predictor.is_image_set = True
+        return True
+        
+    @torch.inference_mode()
+    def release_image(self, cache_key: Optional[str] = None):
+        """
+        Free the device memory held by the current image embedding.
+        
+        Args:
+            cache_key: Optional content hash of the image. Its cached embedding
+                is moved to host memory so it can still be restored later.
+        """
+        if self.predictor is None:
+            raise RuntimeError("Model predictor not initialized")
+            
+        self.predictor.reset_image()
+        
+        if cache_key is not None:
+            entry = self.embedding_cache.get(cache_key)
+            if entry is not None:
+                entry["features"] = entry["features"].cpu()
+                
+        if self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+        
+    @torch.inference_mode()
+    def set_image(
+        self,
+        image: np.ndarray,
+        cache_key: Optional[str] = None,
+        original_size: Optional[Tuple[int, int]] = None
+    ):
+        """
+        Set the image for segmentation.
+        
+        Args:
+            image: RGB image to encode
+            cache_key: Optional content hash of the image. When given, the
+                embedding is reused from (and stored in) the embedding cache.
+            original_size: (height, width) of the full-resolution image when
+                `image` has been downscaled. Masks and prompts use this size.
+        """
+        if self.predictor is None:
+            raise RuntimeError("Model predictor not initialized")
+            
+        if cache_key is not None and self.restore_image(cache_key):
+            return True
+                
+        self._encode_image(image, original_size or image.shape[:2])
+        
+        if cache_key is not None:
+            self.embedding_cache.put(cache_key, {
+                "features": self.predictor.features,
+                "original_size": self.predictor.original_size,
+                "input_size": self.predictor.input_size
+            })
         return True
         
+    def _predict(
+        self,
+        point_coords: Optional[np.ndarray] = None,
+        point_labels: Optional[np.ndarray] = None,
+        box: Optional[np.ndarray] = None,
+        top_k: int = 3
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Run the mask decoder with prompts moved to the device once.
+        
+        The top_k masks are selected by score on the device, so only those
+        are copied back to the host, and the low-resolution logits never
+        leave the device. Masks are always returned in descending score order.
+        """
+        original_size = self.predictor.original_size
+        transform = self.predictor.transform
+        
+        coords_torch, labels_torch, box_torch = None, None, None
+        if point_coords is not None:
+            coords_torch = torch.as_tensor(point_coords, dtype=torch.float, device=self.device)
+            coords_torch = transform.apply_coords_torch(coords_torch, original_size)[None, :, :]
+            labels_torch = torch.as_tensor(point_labels, dtype=torch.int, device=self.device)[None, :]
+        if box is not None:
+            box_torch = torch.as_tensor(box, dtype=torch.float, device=self.device)
+            box_torch = transform.apply_boxes_torch(box_torch, original_size)
+            
+        masks, scores, _ = self.predictor.predict_torch(
+            coords_torch,
+            labels_torch,
+            box_torch,
+            multimask_output=top_k > 1
+        )
+        masks, scores = masks[0], scores[0]
+        order = torch.argsort(scores, descending=True)[:top_k]
+        masks, scores = masks[order], scores[order]
+        return masks.cpu().numpy(), scores.float().cpu().numpy()
+        
+    def _predict_grid(
+        self,
+        points_per_side: int,
+        points_per_batch: int,
+        score_threshold: float = 0.88,
+        stability_threshold: float = 0.95,
+        stability_offset: float = 1.0,
+        nms_threshold: float = 0.7
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Segment everything by decoding a regular grid of point prompts in batches.
+        
+        Each batch of points runs through the prompt encoder and mask decoder
+        once against the current image embedding. Like SamAutomaticMaskGenerator,
+        only the best of the three masks per point is kept, masks are filtered
+        by predicted IoU and stability score, and duplicates are dropped by
+        non-maximum suppression on their boxes. The thresholds default to its
+        values. Unlike it, the image is not cropped into tiles, and stability
+        and boxes are computed at the encoder's input resolution with the boxes
+        scaled to the original image, so memory doesn't grow with image size.
+        
+        Yields:
+            Chunks of (masks, scores) at the original resolution, sized so the
+            upsampled logits of a chunk stay within GRID_UPSAMPLE_PIXELS
+        """
+        if points_per_side < 1 or points_per_batch < 1:
+            raise ValueError("points_per_side and points_per_batch must be at least 1")
+            
+        sam = self.predictor.model
+        original_size = self.predictor.original_size
+        input_size = self.predictor.input_size
+        transform = self.predictor.transform
+        img_size = sam.image_encoder.img_size
+        
+        # Grid cell centres in original image coordinates
+        height, width = original_size
+        steps = (torch.arange(points_per_side, device=self.device, dtype=torch.float) + 0.5) / points_per_side
+        grid_y, grid_x = torch.meshgrid(steps * height, steps * width, indexing="ij")
+        grid = torch.stack([grid_x.reshape(-1), grid_y.reshape(-1)], dim=1)
+        grid = transform.apply_coords_torch(grid, original_size)
+        
+        # Boxes found at input resolution are scaled back to the original image
+        box_scale = torch.tensor(
+            [width / input_size[1], height / input_size[0]] * 2,
+            device=self.device
+        )
+        
+        image_pe = sam.prompt_encoder.get_dense_pe()
+        all_logits, all_scores, all_boxes = [], [], []
+        for start in range(0, len(grid), points_per_batch):
+            coords = grid[start:start + points_per_batch, None, :]
+            labels = torch.ones(coords.shape[:2], dtype=torch.int, device=self.device)
+            sparse_embeddings, dense_embeddings = sam.prompt_encoder(
+                points=(coords, labels),
+                boxes=None,
+                masks=None
+            )
+            low_res_logits, iou_predictions = sam.mask_decoder(
+                image_embeddings=self.predictor.features,
+                image_pe=image_pe,
+                sparse_prompt_embeddings=sparse_embeddings,
+                dense_prompt_embeddings=dense_embeddings,
+                multimask_output=True
+            )
+            
+            # Keep the best of the three masks for each point
+            best = iou_predictions.argmax(dim=1)
+            rows = torch.arange(len(best), device=self.device)
+            logits, scores = low_res_logits[rows, best], iou_predictions[rows, best]
+            
+            keep = scores > score_threshold
+            logits, scores = logits[keep], scores[keep]
+            if len(logits) == 0:
+                continue
+                
+            # Masks that change a lot with the threshold are unreliable
+            upscaled = F.interpolate(logits[:, None, :, :], (img_size, img_size), mode="bilinear", align_corners=False)
+            upscaled = upscaled[:, 0, :input_size[0], :input_size[1]]
+            stability = calculate_stability_score(upscaled, sam.mask_threshold, stability_offset)
+            keep = stability >= stability_threshold
+            
+            all_logits.append(logits[keep])
+            all_scores.append(scores[keep])
+            all_boxes.append(batched_mask_to_box(upscaled[keep] > sam.mask_threshold).float() * box_scale)
+            
+        if not all_logits:
+            return
+            
+        # Drop duplicate masks from neighbouring points by box overlap
+        logits = torch.cat(all_logits)
+        scores = torch.cat(all_scores).float()
+        boxes = torch.cat(all_boxes)
+        keep = batched_nms(boxes, scores, torch.zeros_like(scores), iou_threshold=nms_threshold)
+        logits, scores = logits[keep], scores[keep]
+        
+        # Upsample the survivors to the original size a few at a time
+        chunk_size = min(points_per_batch, max(1, GRID_UPSAMPLE_PIXELS // (height * width)))
+        for start in range(0, len(logits), chunk_size):
+            chunk = logits[start:start + chunk_size, None, :, :]
+            masks = sam.postprocess_masks(chunk, input_size, original_size)[:, 0] > sam.mask_threshold
+            yield masks.cpu().numpy(), scores[start:start + chunk_size].cpu().numpy()
+        
+    @torch.inference_mode()
     def predict_masks(
         self, 
         points: Optional[List[List[int]]] = None, 
         point_labels: Optional[List[int]] = None,
         box: Optional[List[int]] = None,
-        mode: str = "auto"
+        mode: str = "auto",
+        top_k: int = 3,
+        points_per_side: int = 32,
+        points_per_batch: int = 64
     ) -> Dict[str, Any]:
         """
         Predict masks for the image using different prompts.
@@ -140,7 +700,12 @@ class SAMModel:
             points: List of [x, y] coordinates to use as point prompts
             point_labels: List of labels for each point (1 for foreground, 0 for background)
             box: Box prompt in format [x1, y1, x2, y2]
-            mode: Prediction mode - "auto" (automatic mask generation), "point" (point prompts), "box" (box prompt)
+            mode: Prediction mode - "auto" (automatic mask generation), "point" (point prompts), "box" (box prompt),
+                "grid" (segment everything from a grid of point prompts)
+            top_k: Number of highest-scoring masks to return, best first. With 1,
+                the decoder predicts a single mask instead of three. Not used in grid mode
+            points_per_side: Grid points along each side of the image in grid mode
+            points_per_batch: Grid points decoded together in grid mode
             
         Returns:
             Dictionary with masks, scores, and bounding boxes
@@ -149,58 +714,50 @@ class SAMModel:
             raise RuntimeError("Model predictor not initialized")
             
         try:
+            if top_k < 1:
+                raise ValueError("top_k must be at least 1")
+            
+            # Convert prompts to arrays once
+            point_coords, point_labels_array, box_array = _prompt_arrays(points, point_labels, box)
+            
             if mode == "auto":
                 # Generate masks automatically
-                masks, scores, logits = self.predictor.predict(
-                    multimask_output=True,
-                    point_coords=points,
-                    point_labels=point_labels,
-                    box=box
+                masks, scores = self._predict(
+                    top_k=top_k,
+                    point_coords=point_coords,
+                    point_labels=point_labels_array,
+                    box=box_array
                 )
                 
-            elif mode == "point" and points is not None and point_labels is not None:
+            elif mode == "point" and point_coords is not None and point_labels_array is not None:
                 # Generate masks from point prompts
-                masks, scores, logits = self.predictor.predict(
-                    point_coords=np.array(points),
-                    point_labels=np.array(point_labels),
-                    multimask_output=True
+                masks, scores = self._predict(
+                    point_coords=point_coords,
+                    point_labels=point_labels_array,
+                    top_k=top_k
                 )
                 
-            elif mode == "box" and box is not None:
+            elif mode == "box" and box_array is not None:
                 # Generate masks from box prompt
-                masks, scores, logits = self.predictor.predict(
-                    box=np.array(box),
-                    multimask_output=True
+                masks, scores = self._predict(
+                    box=box_array,
+                    top_k=top_k
                 )
                 
+            elif mode == "grid":
+                # Generate masks for everything in the image, encoding each chunk
+                # before the next one is upsampled
+                mask_data, count = [], 0
+                for masks, scores in self._predict_grid(points_per_side, points_per_batch):
+                    mask_data.extend(_encode_masks(masks, scores, start=count))
+                    count += len(masks)
+                    
             else:
                 raise ValueError(f"Invalid mode '{mode}' or missing required prompts")
                 
             # Process results
-            mask_data = []
-            for i, (mask, score) in enumerate(zip(masks, scores)):
-                # Find bounding box for the mask
-                y_indices, x_indices = np.where(mask)
-                if len(y_indices) > 0 and len(x_indices) > 0:
-                    x_min, x_max = int(np.min(x_indices)), int(np.max(x_indices))
-                    y_min, y_max = int(np.min(y_indices)), int(np.max(y_indices))
-                    width, height = x_max - x_min, y_max - y_min
-                    
-                    # Calculate area of the mask
-                    area = int(np.sum(mask))
-                    
-                    # Convert mask to binary and then to list of integers for serialization
-                    # (we'll reconstruct this on the client)
-                    binary_mask = mask.astype(np.uint8) * 255
-                    mask_flat = binary_mask.flatten().tolist()
-                    
-                    mask_data.append({
-                        "id": i,
-                        "score": float(score),
-                        "bbox": [x_min, y_min, width, height],
-                        "mask_data": mask_flat,
-                        "area": area
-                    })
+            if mode != "grid":
+                mask_data = _encode_masks(masks, scores)
                     
             return {
                 "masks": mask_data,
@@ -214,10 +771,14 @@ class SAMModel:
 
 # Singleton instance
 _model_instance = None
+_model_lock = threading.Lock()
 
 def get_model() -> SAMModel:
     """Get or create the SAM model instance."""
     global _model_instance
     if _model_instance is None:
-        _model_instance = SAMModel()
+        # Only one caller may load the checkpoint; others wait for it
+        with _model_lock:
+            if _model_instance is None:
+                _model_instance = SAMModel()
     return _model_instance 
\ No newline at end of file
@@ -1,27 +1,173 @@
 import os
 import io
+import glob
+import tempfile
+import asyncio
+import hashlib
 import logging
+from collections import OrderedDict
 import cv2
 import numpy as np
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, BinaryIO
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends, BackgroundTasks
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, ORJSONResponse
 from pydantic import ValidationError
 
 from app.models.sam_model import get_model, SAMModel
+from app.models.inference_queue import get_inference_queue, InferenceQueue
+from app.models.image_store import get_image_store, ImageStore
 from app.schemas.segmentation import SegmentationRequest, SegmentationResult, ExportRequest
-from app.utils.image_utils import read_image, save_uploaded_image, create_transparent_image_with_masks, decode_mask
+from app.utils.image_utils import (
+    read_image_for_segmentation, save_uploaded_image,
+    create_transparent_image_with_masks, decode_masks_union
+)
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-# Store uploaded images and their masks in memory
-# This is a simplification for development. In production, use a DB or file system.
-IMAGE_STORE = {}
+# Maximum accepted upload size in bytes
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 20 * 1024 * 1024))
+
+# Stored fields needed to encode an image, so segmentation requests don't load its masks
+IMAGE_INPUT_FIELDS = ["file_path", "image_hash"]
+
+# Chunk size for streaming uploads
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+# Recent segmentation results keyed by image hash and prompts, so repeated
+# identical requests (double clicks, retries) skip inference entirely
+RESULT_CACHE: "OrderedDict[Tuple, Dict[str, Any]]" = OrderedDict()
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 32))
+
+def _cache_result(key: Tuple, result: Dict[str, Any]):
+    """Store a segmentation result, evicting the least recently used one if full."""
+    RESULT_CACHE[key] = result
+    RESULT_CACHE.move_to_end(key)
+    while len(RESULT_CACHE) > RESULT_CACHE_SIZE:
+        RESULT_CACHE.popitem(last=False)
+
+async def _update_image(image_store: ImageStore, image_id: str, **fields):
+    """Update a stored image, or 404 if it was removed while the request ran."""
+    try:
+        await image_store.update(image_id, **fields)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+def _read_segmentation_input(file_path: str, model: SAMModel) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """Read a stored upload at the resolution the model needs."""
+    try:
+        return read_image_for_segmentation(file_path, model.image_size)
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=f"Failed to read image from {file_path}: {str(e)}")
+
+async def _load_segmentation_input(
+    image_data: Dict[str, Any],
+    model: SAMModel
+) -> Tuple[Optional[np.ndarray], Optional[Tuple[int, int]]]:
+    """
+    Decode a stored upload off the event loop, unless its embedding is already cached.
+    
+    Returns (None, None) on a cache hit; the inference worker then restores
+    the cached embedding instead of encoding the image.
+    """
+    if image_data["image_hash"] in model.embedding_cache:
+        return None, None
+    return await asyncio.to_thread(_read_segmentation_input, image_data["file_path"], model)
+
+def _set_image(
+    model: SAMModel,
+    file_path: str,
+    image: Optional[np.ndarray],
+    original_size: Optional[Tuple[int, int]],
+    cache_key: str
+):
+    """Set the predictor image, from cache when possible. Runs on the inference worker."""
+    if image is None:
+        if model.restore_image(cache_key):
+            return
+        # The embedding was evicted while the job was queued
+        image, original_size = _read_segmentation_input(file_path, model)
+    model.set_image(image, cache_key=cache_key, original_size=original_size)
+
+def _run_segmentation(
+    model: SAMModel,
+    file_path: str,
+    image: Optional[np.ndarray],
+    original_size: Optional[Tuple[int, int]],
+    cache_key: str,
+    release_after: bool = False,
+    **prompts
+) -> Dict[str, Any]:
+    """Encode the image and predict masks. Runs on the inference worker."""
+    _set_image(model, file_path, image, original_size, cache_key)
+    result = model.predict_masks(**prompts)
+    if release_after:
+        model.release_image(cache_key)
+    return result
+
+def _read_image_file(file_path: str) -> np.ndarray:
+    """Read a stored upload from disk."""
+    image = cv2.imread(file_path)
+    if image is None:
+        raise HTTPException(status_code=500, detail=f"Failed to read image from {file_path}")
+    return image
+
+def _store_upload(file_obj: BinaryIO) -> Tuple[str, str]:
+    """
+    Hash an upload and write it to disk, returning (image_hash, file_path).
+    
+    The spooled upload is streamed in chunks, so it is never held in memory
+    as a single bytes object.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    size = 0
+    file_obj.seek(0)
+    for chunk in iter(lambda: file_obj.read(UPLOAD_CHUNK_BYTES), b""):
+        size += len(chunk)
+        if size > MAX_UPLOAD_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"File is too large (limit is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB)"
+            )
+        hasher.update(chunk)
+        
+    file_obj.seek(0)
+    return hasher.hexdigest(), save_uploaded_image(file_obj)
+
+def _export_path(image_id: str, rles: List[str]) -> str:
+    """Path of the export for a selection of masks, named by the masks it contains."""
+    hasher = hashlib.blake2b(digest_size=8)
+    for rle in rles:
+        hasher.update(rle.encode("ascii"))
+        hasher.update(b"\n")
+    return f"uploads/export_{image_id}_{hasher.hexdigest()}.png"
+
+def _write_export(file_path: str, rles: List[str], size: Tuple[int, int], export_path: str):
+    """Read the upload, composite the selected masks and write the transparent PNG to disk."""
+    image = _read_image_file(file_path)
+    height, width = size
+    union = decode_masks_union(rles, width, height)
+    transparent_img = create_transparent_image_with_masks(image, [union])
+    
+    # Write to a temporary file first so a concurrent request never serves a
+    # half-written export. OpenCV calls libpng directly on the BGRA array; low
+    # zlib effort encodes several times faster for a small size increase
+    fd, temp_path = tempfile.mkstemp(suffix=".png", dir=os.path.dirname(export_path))
+    os.close(fd)
+    try:
+        if not cv2.imwrite(temp_path, transparent_img, [cv2.IMWRITE_PNG_COMPRESSION, 1]):
+            raise ValueError(f"Failed to write export to {export_path}")
+        os.replace(temp_path, export_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
 
 @router.post("/upload", status_code=201)
-async def upload_image(file: UploadFile = File(...)):
+async def upload_image(
+    file: UploadFile = File(...),
+    image_store: ImageStore = Depends(get_image_store)
+):
     """
     Upload an image for segmentation.
     
@@ -32,21 +178,23 @@ async def upload_image(file: UploadFile = File(...)):
         if not file.content_type.startswith("image/"):
             raise HTTPException(status_code=400, detail="File must be an image")
             
-        # Read file content
-        contents = await file.read()
-        
-        # Save uploaded file
-        file_path = save_uploaded_image(contents)
+        # Hash and save the upload off the event loop, stopping as soon as the
+        # size limit is exceeded; identical uploads share cached embeddings
+        try:
+            image_hash, file_path = await asyncio.to_thread(_store_upload, file.file)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
         # Generate a unique ID for this image session
         image_id = os.path.basename(file_path).split('.')[0]
         
         # Store image path for later use
-        IMAGE_STORE[image_id] = {
+        await image_store.set(image_id, {
             "file_path": file_path,
+            "image_hash": image_hash,
             "masks": None,
             "segmented": False
-        }
+        })
         
         # Return image ID and URL
         return {
@@ -57,13 +205,18 @@ async def upload_image(file: UploadFile = File(...)):
     
     except Exception as e:
         logger.error(f"Error uploading image: {e}")
+        if isinstance(e, HTTPException):
+            raise
         raise HTTPException(status_code=500, detail=f"Failed to upload image: {str(e)}")
 
-@router.post("/segment/{image_id}", response_model=SegmentationResult)
+@router.post("/segment/{image_id}", response_model=SegmentationResult, response_class=ORJSONResponse)
 async def segment_image(
     image_id: str,
     segmentation_request: SegmentationRequest = None,
-    model: SAMModel = Depends(get_model)
+    release_after: bool = False,
+    image_store: ImageStore = Depends(get_image_store),
+    model: SAMModel = Depends(get_model),
+    inference_queue: InferenceQueue = Depends(get_inference_queue)
 ):
     """
     Run segmentation on the uploaded image.
@@ -71,43 +224,71 @@ async def segment_image(
     Parameters:
         - image_id: ID of the uploaded image
         - segmentation_request: Optional parameters for segmentation
+        - release_after: Free the image embedding's device memory after predicting,
+          keeping a host copy in the embedding cache
     
     Returns:
         - List of masks, each with ID, bounding box, and score
     """
     try:
         # Check if image exists
-        if image_id not in IMAGE_STORE:
+        image_data = await image_store.get(image_id, fields=IMAGE_INPUT_FIELDS)
+        if image_data is None:
             raise HTTPException(status_code=404, detail="Image not found")
             
-        image_data = IMAGE_STORE[image_id]
-        file_path = image_data["file_path"]
-        
-        # Read image
-        image = cv2.imread(file_path)
-        if image is None:
-            raise HTTPException(status_code=500, detail=f"Failed to read image from {file_path}")
-            
-        # Set image in the model
-        model.set_image(image)
-        
         # Extract segmentation parameters
         points = segmentation_request.points if segmentation_request else None
         point_labels = segmentation_request.point_labels if segmentation_request else None
         box = segmentation_request.box if segmentation_request else None
         mode = segmentation_request.mode if segmentation_request else "auto"
+        top_k = segmentation_request.return_top_k if segmentation_request else 3
+        points_per_side = segmentation_request.points_per_side if segmentation_request else 32
+        points_per_batch = segmentation_request.points_per_batch if segmentation_request else 64
         
-        # Run prediction
-        result = model.predict_masks(
+        # Return the previous result for an identical request
+        cache_key = (
+            image_data["image_hash"],
+            mode,
+            top_k,
+            points_per_side,
+            tuple(map(tuple, points)) if points is not None else None,
+            tuple(point_labels) if point_labels is not None else None,
+            tuple(box) if box is not None else None
+        )
+        result = RESULT_CACHE.get(cache_key)
+        if result is not None:
+            RESULT_CACHE.move_to_end(cache_key)
+            
+            # The embedding may still be on the device from an earlier request
+            if release_after:
+                await inference_queue.submit(model.release_image, image_data["image_hash"])
+            await _update_image(image_store, image_id, masks=result, segmented=True)
+            return result
+            
+        # Read image
+        image, original_size = await _load_segmentation_input(image_data, model)
+        
+        # Run encoding and prediction on the inference worker
+        result = await inference_queue.submit(
+            _run_segmentation,
+            model,
+            image_data["file_path"],
+            image,
+            original_size,
+            image_data["image_hash"],
+            release_after=release_after,
             points=points, 
             point_labels=point_labels,
             box=box,
-            mode=mode
+            mode=mode,
+            top_k=top_k,
+            points_per_side=points_per_side,
+            points_per_batch=points_per_batch
         )
+        _cache_result(cache_key, result)
         
         # Store masks for later use
-        IMAGE_STORE[image_id]["masks"] = result
-        IMAGE_STORE[image_id]["segmented"] = True
+        await _update_image(image_store, image_id, masks=result, segmented=True)
         
         return result
         
@@ -117,10 +298,50 @@ async def segment_image(
             raise
         raise HTTPException(status_code=500, detail=f"Failed to segment image: {str(e)}")
 
+@router.post("/prepare/{image_id}")
+async def prepare_image(
+    image_id: str,
+    image_store: ImageStore = Depends(get_image_store),
+    model: SAMModel = Depends(get_model),
+    inference_queue: InferenceQueue = Depends(get_inference_queue)
+):
+    """
+    Compute and cache the image embedding without predicting masks.
+    
+    Clients can call this right after upload so the first segmentation
+    request only has to run the lightweight mask decoder.
+    """
+    try:
+        # Check if image exists
+        image_data = await image_store.get(image_id, fields=IMAGE_INPUT_FIELDS)
+        if image_data is None:
+            raise HTTPException(status_code=404, detail="Image not found")
+            
+        
+        image, original_size = await _load_segmentation_input(image_data, model)
+        if image is not None:
+            await inference_queue.submit(
+                _set_image,
+                model,
+                image_data["file_path"],
+                image,
+                original_size,
+                image_data["image_hash"]
+            )
+            
+        return {"status": "success", "image_id": image_id}
+        
+    except Exception as e:
+        logger.error(f"Error preparing image: {e}")
+        if isinstance(e, HTTPException):
+            raise
+        raise HTTPException(status_code=500, detail=f"Failed to prepare image: {str(e)}")
+
 @router.post("/export/{image_id}")
 async def export_image(
     image_id: str,
-    export_request: ExportRequest
+    export_request: ExportRequest,
+    image_store: ImageStore = Depends(get_image_store)
 ):
     """
     Export selected segments as a transparent PNG.
@@ -134,19 +355,13 @@ async def export_image(
     """
     try:
         # Check if image exists and was segmented
-        if image_id not in IMAGE_STORE:
+        image_data = await image_store.get(image_id)
+        if image_data is None:
             raise HTTPException(status_code=404, detail="Image not found")
             
-        image_data = IMAGE_STORE[image_id]
         if not image_data["segmented"] or not image_data["masks"]:
             raise HTTPException(status_code=400, detail="Image has not been segmented yet")
             
-        # Read original image
-        file_path = image_data["file_path"]
-        image = cv2.imread(file_path)
-        if image is None:
-            raise HTTPException(status_code=500, detail=f"Failed to read image from {file_path}")
-            
         # Get masks data
         masks_data = image_data["masks"]["masks"]
         image_width = image_data["masks"]["image_width"]
@@ -155,27 +370,27 @@ async def export_image(
         # Find selected masks
         selected_mask_ids = export_request.mask_ids
         
+        # Get the selected mask data, looking masks up by ID
+        masks_by_id = {mask["id"]: mask for mask in masks_data}
+        export_ids = sorted({mask_id for mask_id in selected_mask_ids if mask_id in masks_by_id})
+        
         # Check if any of the requested masks exists
-        valid_mask_ids = [mask["id"] for mask in masks_data]
-        if not any(mask_id in valid_mask_ids for mask_id in selected_mask_ids):
+        if not export_ids:
             raise HTTPException(status_code=400, detail="None of the requested mask IDs exist")
         
-        # Get the selected mask data
-        selected_masks = []
-        for mask_id in selected_mask_ids:
-            for mask_data in masks_data:
-                if mask_data["id"] == mask_id:
-                    # Decode the mask data
-                    binary_mask = decode_mask(mask_data["mask_data"], image_width, image_height)
-                    selected_masks.append(binary_mask)
-                    break
-        
-        # Create transparent image with the selected masks
-        transparent_img = create_transparent_image_with_masks(image, selected_masks)
-        
-        # Save the result to a temporary file
-        export_path = f"uploads/export_{image_id}.png"
-        transparent_img.save(export_path, format="PNG")
+        # Exports are named by their masks, so the same selection is only written once
+        rles = [masks_by_id[mask_id]["rle"] for mask_id in export_ids]
+        export_path = _export_path(image_id, rles)
+        if not os.path.exists(export_path):
+            # Read the original image, decode the masks and create the transparent image
+            # off the event loop
+            await asyncio.to_thread(
+                _write_export,
+                image_data["file_path"],
+                rles,
+                (image_height, image_width),
+                export_path
+            )
         
         # Return the file
         return FileResponse(
@@ -190,31 +405,69 @@ async def export_image(
             raise
         raise HTTPException(status_code=500, detail=f"Failed to export image: {str(e)}")
         
+def _drop_cached(image_hash: str, model: SAMModel):
+    """Drop the cached embedding and results for an image hash."""
+    # An evicted embedding stays valid for a job that has already restored it
+    model.embedding_cache.pop(image_hash)
+    for key in [key for key in RESULT_CACHE if key[0] == image_hash]:
+        del RESULT_CACHE[key]
+        
+def _remove_image_files(image_id: str, file_path: str):
+    """Delete an upload and its exports from disk."""
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    for export_path in glob.glob(f"uploads/export_{image_id}_*.png"):
+        os.remove(export_path)
+        
+async def _remove_image(image_id: str, image_store: ImageStore, model: SAMModel) -> bool:
+    """Remove an image, its files and cached data. Returns False if it doesn't exist."""
+    # Remove from image store
+    image_data = await image_store.delete(image_id)
+    if image_data is None:
+        return False
+        
+    # Get file path
+    file_path = image_data["file_path"]
+    image_hash = image_data["image_hash"]
+    
+    # Delete the upload and any exported files off the event loop
+    await asyncio.to_thread(_remove_image_files, image_id, file_path)
+        
+    # Drop the cached embedding and results unless an identical upload still uses them
+    if not await image_store.has_hash(image_hash):
+        _drop_cached(image_hash, model)
+        
+    return True
+
+async def remove_expired_images(image_store: ImageStore, model: SAMModel):
+    """Remove images that haven't been used within the image store's TTL."""
+    for image_id in await image_store.expired():
+        try:
+            if await _remove_image(image_id, image_store, model):
+                logger.info(f"Removed expired image {image_id}")
+        except Exception as e:
+            logger.error(f"Error removing expired image {image_id}: {e}")
+            
+    # With a shared store, other workers remove images whose embeddings and
+    # results this process may still cache
+    cached_hashes = set(model.embedding_cache.keys())
+    cached_hashes.update(key[0] for key in RESULT_CACHE)
+    for image_hash in cached_hashes - await image_store.stored_hashes(cached_hashes):
+        _drop_cached(image_hash, model)
+
 @router.delete("/image/{image_id}")
-async def delete_image(image_id: str):
+async def delete_image(
+    image_id: str,
+    image_store: ImageStore = Depends(get_image_store),
+    model: SAMModel = Depends(get_model)
+):
     """
     Delete an uploaded image and its associated data.
     """
     try:
-        # Check if image exists
-        if image_id not in IMAGE_STORE:
+        if not await _remove_image(image_id, image_store, model):
             raise HTTPException(status_code=404, detail="Image not found")
             
-        # Get file path
-        file_path = IMAGE_STORE[image_id]["file_path"]
-        
-        # Delete from storage if exists
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            
-        # Remove from image store
-        del IMAGE_STORE[image_id]
-        
-        # Delete any exported files
-        export_path = f"uploads/export_{image_id}.png"
-        if os.path.exists(export_path):
-            os.remove(export_path)
-            
         return {"status": "success", "message": "Image deleted successfully"}
         
     except Exception as e:
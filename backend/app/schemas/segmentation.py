@@ -1,13 +1,16 @@
 from typing import List, Dict, Any, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class SegmentationRequest(BaseModel):
     """Request model for segmentation endpoint."""
     points: Optional[List[List[int]]] = None
     point_labels: Optional[List[int]] = None
-    mode: str = "auto"  # "auto", "point", "box"
+    mode: str = "auto"  # "auto", "point", "box", "grid"
     box: Optional[List[int]] = None  # [x1, y1, x2, y2]
+    return_top_k: int = Field(3, ge=1, le=3)  # Highest-scoring masks to return, best first; 1 predicts a single mask
+    points_per_side: int = Field(32, ge=1, le=64)  # Grid size in "grid" mode
+    points_per_batch: int = Field(64, ge=1, le=128)  # Grid points decoded together in "grid" mode
 
 
 class Mask(BaseModel):
@@ -15,7 +18,7 @@ class Mask(BaseModel):
     id: int
     score: float
     bbox: List[int]  # [x, y, width, height]
-    mask_data: List[int]  # Base64 encoded binary mask data
+    rle: str  # Base64 uint32 run lengths of the row-major mask, starting with background
     area: int
 
 
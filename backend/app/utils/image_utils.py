@@ -1,106 +1,201 @@
 import cv2
 import numpy as np
 import io
+import base64
 import os
+import shutil
 import uuid
-from PIL import Image
+from PIL import Image, ImageOps
 from typing import List, Tuple, Dict, Any, Optional
 
 def read_image(file) -> np.ndarray:
-    """Read an image file and convert to RGB format."""
+    """Read an image file into a BGR array for OpenCV."""
     try:
-        # Read image using PIL
-        image = Image.open(io.BytesIO(file))
-        image = image.convert('RGB')
-        image_np = np.array(image)
-        
-        # Convert from RGB to BGR for OpenCV compatibility
-        image_np = cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR)
+        # OpenCV decodes straight to BGR, without a PIL image or a channel swap
+        image_np = cv2.imdecode(np.frombuffer(file, np.uint8), cv2.IMREAD_COLOR)
+        if image_np is None:
+            raise ValueError("unsupported or corrupt image data")
         return image_np
     except Exception as e:
         raise ValueError(f"Error reading image: {str(e)}")
 
+# Largest accepted image in pixels; PIL also refuses to open anything far beyond this
+MAX_IMAGE_PIXELS = 50_000_000
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# Upload formats that are stored as-is; everything else is converted to PNG
+STORED_FORMATS = {
+    "PNG": ".png",
+    "JPEG": ".jpg",
+    "WEBP": ".webp",
+    "BMP": ".bmp",
+    "TIFF": ".tiff"
+}
+
 def save_uploaded_image(file, directory="uploads") -> str:
-    """Save an uploaded file to disk and return the file path."""
+    """
+    Save an uploaded file to disk and return the file path.
+    
+    Formats OpenCV can read are written byte-for-byte instead of being decoded
+    and re-encoded; other formats are converted to PNG.
+    
+    Args:
+        file: Upload contents as bytes, or a seekable binary file object
+        directory: Directory to save into
+    """
     # Create directory if it doesn't exist
     os.makedirs(directory, exist_ok=True)
     
-    # Generate a unique filename
-    filename = f"{uuid.uuid4()}.png"
-    file_path = os.path.join(directory, filename)
-    
-    # Read and save the image
+    if isinstance(file, (bytes, bytearray)):
+        file = io.BytesIO(file)
+        
     try:
-        image = Image.open(io.BytesIO(file))
-        image.save(file_path)
+        # Opening only parses the header, so this validates without decoding pixels
+        with Image.open(file) as image:
+            if image.width * image.height > MAX_IMAGE_PIXELS:
+                raise ValueError(f"Image is too large ({image.width}x{image.height} pixels)")
+                
+            extension = STORED_FORMATS.get(image.format, ".png")
+            
+            # Generate a unique filename
+            filename = f"{uuid.uuid4()}{extension}"
+            file_path = os.path.join(directory, filename)
+            
+            if image.format in STORED_FORMATS:
+                file.seek(0)
+                with open(file_path, "wb") as f:
+                    shutil.copyfileobj(file, f)
+            else:
+                image.save(file_path)
         return file_path
     except Exception as e:
         raise ValueError(f"Error saving image: {str(e)}")
 
+def read_image_for_segmentation(file_path: str, max_dimension: int) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """
+    Read a stored image as RGB for the segmentation model.
+    
+    JPEGs are decoded directly at a reduced scale that still covers
+    max_dimension, since the model downsizes its input anyway. Anything
+    larger is then resized so its longest side is max_dimension.
+    
+    Args:
+        file_path: Path of the image on disk
+        max_dimension: Input size of the model's image encoder
+        
+    Returns:
+        The (possibly downscaled) RGB image and the original (height, width)
+    """
+    try:
+        with Image.open(file_path) as image:
+            # Sizes are reported after applying EXIF orientation, like cv2.imread does
+            height, width = image.height, image.width
+            if image.getexif().get(0x0112) in (5, 6, 7, 8):
+                height, width = width, height
+                
+            # Let libjpeg downscale by 1/2, 1/4 or 1/8 while decoding
+            image.draft("RGB", (max_dimension, max_dimension))
+            image_np = np.asarray(ImageOps.exif_transpose(image.convert("RGB")))
+        
+        # Shrink anything still larger here, in the decoding thread, so large
+        # buffers aren't queued and the inference worker doesn't resize them.
+        # Rounding matches SAM's ResizeLongestSide, so the model won't resize again.
+        decoded_height, decoded_width = image_np.shape[:2]
+        if max(decoded_height, decoded_width) > max_dimension:
+            scale = max_dimension / max(decoded_height, decoded_width)
+            new_size = (int(decoded_width * scale + 0.5), int(decoded_height * scale + 0.5))
+            image_np = cv2.resize(image_np, new_size, interpolation=cv2.INTER_AREA)
+            
+        return image_np, (height, width)
+    except Exception as e:
+        raise ValueError(f"Error reading image: {str(e)}")
+
 def create_transparent_image_with_masks(
     image: np.ndarray, 
     masks: List[np.ndarray]
-) -> Image.Image:
+) -> np.ndarray:
     """
-    Create a transparent PNG with only the selected masks visible.
+    Create a transparent image with only the selected masks visible.
     
     Args:
         image: Original image
         masks: List of binary masks to include
         
     Returns:
-        PIL Image with transparent background
+        4-channel image with transparent background, in the channel order of
+        `image` plus alpha (BGRA for images read with OpenCV)
     """
     try:
-        # Create an empty RGBA image (transparent)
         height, width = image.shape[:2]
-        transparent_img = np.zeros((height, width, 4), dtype=np.uint8)
         
-        # For each mask, add the corresponding pixels from the original image
+        # Union all masks in place so the image is only composited once
+        union = np.zeros((height, width), dtype=bool)
         for mask in masks:
-            # Ensure mask is binary
-            binary_mask = mask.astype(bool)
+            np.logical_or(union, mask.astype(bool, copy=False), out=union)
             
-            # Extract RGB from original image where mask is True
-            for c in range(3):  # RGB channels
-                transparent_img[:, :, c] = np.where(
-                    binary_mask, 
-                    image[:, :, c],
-                    transparent_img[:, :, c]
-                )
-                
-            # Set alpha channel to 255 (fully opaque) where mask is True
-            transparent_img[:, :, 3] = np.where(binary_mask, 255, transparent_img[:, :, 3])
-        
-        # Convert to PIL image
-        pil_image = Image.fromarray(transparent_img)
-        return pil_image
+        # Add an opaque alpha channel, then one masked AND clears color and
+        # alpha together outside the masks (OpenCV zero-fills the new output)
+        union_u8 = union.view(np.uint8)
+        bgra = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+        return cv2.bitwise_and(bgra, bgra, mask=union_u8)
         
     except Exception as e:
         raise ValueError(f"Error creating transparent image: {str(e)}")
 
-def decode_mask(mask_data: List[int], image_width: int, image_height: int) -> np.ndarray:
+def encode_rle(mask: np.ndarray) -> str:
+    """
+    Encode a binary mask as base64 run-length counts.
+    
+    Runs are taken over the row-major flattened mask and alternate between
+    background and foreground, starting with background (so the first count
+    may be 0). Counts are stored as little-endian uint32.
+    
+    Args:
+        mask: 2D boolean or 0/1 mask
+        
+    Returns:
+        Base64 string of the run lengths
+    """
+    flat = mask.ravel().astype(bool, copy=False)
+    
+    # Positions where the value changes start a new run
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    boundaries = np.concatenate(([0], changes, [flat.size]))
+    counts = np.diff(boundaries)
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts))
+        
+    return base64.b64encode(counts.astype("<u4").tobytes()).decode("ascii")
+
+def decode_masks_union(rles: List[str], image_width: int, image_height: int) -> np.ndarray:
     """
-    Decode a serialized mask back to a 2D numpy array.
+    Decode several run-length encoded masks directly into their union.
+    
+    Each foreground run only marks its start and end in a single edge array,
+    and one cumulative sum fills in the covered pixels, so no full-size
+    array is built per mask.
     
     Args:
-        mask_data: Flat list of integers representing the mask
+        rles: Base64 run lengths as produced by encode_rle
         image_width: Width of the original image
         image_height: Height of the original image
         
     Returns:
-        Binary mask as a 2D numpy array
+        Boolean union of the masks as a 2D numpy array
     """
     try:
-        # Convert list to numpy array
-        mask_flat = np.array(mask_data, dtype=np.uint8)
-        
-        # Reshape to 2D
-        mask = mask_flat.reshape(image_height, image_width)
-        
-        # Convert to binary (0 or 1)
-        binary_mask = (mask > 127).astype(np.uint8)
-        
-        return binary_mask
+        edges = np.zeros(image_width * image_height + 1, dtype=np.int32)
+        for rle in rles:
+            counts = np.frombuffer(base64.b64decode(rle), dtype="<u4")
+            run_ends = np.cumsum(counts, dtype=np.int64)
+            
+            # Foreground runs are the odd-indexed ones; runs within a mask never
+            # share a boundary position, so plain fancy-index updates are safe
+            num_runs = len(counts) // 2
+            edges[run_ends[0:2 * num_runs:2]] += 1
+            edges[run_ends[1::2]] -= 1
+            
+        union = np.cumsum(edges[:-1]) > 0
+        return union.reshape(image_height, image_width)
     except Exception as e:
-        raise ValueError(f"Error decoding mask: {str(e)}") 
\ No newline at end of file
+        raise ValueError(f"Error decoding masks: {str(e)}")
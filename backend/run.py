@@ -9,11 +9,17 @@ if __name__ == "__main__":
     # Get port from environment variable or use default
     port = int(os.environ.get("PORT", 8000))
     
+    # Only watch for code changes in development. Each worker loads its own
+    # copy of the model, and workers only share images through REDIS_URL.
+    reload = os.environ.get("DEV", "0") == "1"
+    workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+    
     # Run the server
     uvicorn.run(
         "app.main:app", 
         host="0.0.0.0", 
         port=port, 
-        reload=True,
+        reload=reload,
+        workers=None if reload else workers,
         log_level="info"
     ) 
\ No newline at end of file
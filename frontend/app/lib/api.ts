@@ -5,6 +5,28 @@ import { Mask, SegmentationResult } from './segmentation';
 // Get the API URL from environment variable or default to localhost
 const API_URL = process.env.NEXT_PUBLIC_API_URL || 'http://localhost:8000';
 
+/**
+ * Decode a run-length encoded mask from the backend
+ * @param rle Base64 little-endian uint32 run lengths, alternating background/foreground
+ * @param size Number of pixels in the mask
+ * @returns Binary mask data, 1 for foreground
+ */
+function decodeRle(rle: string, size: number): Uint8Array {
+  const bytes = Uint8Array.from(atob(rle), (c) => c.charCodeAt(0));
+  const counts = new DataView(bytes.buffer);
+  const maskData = new Uint8Array(size);
+
+  let offset = 0;
+  for (let i = 0; i * 4 < bytes.length; i++) {
+    const count = counts.getUint32(i * 4, true);
+    if (i % 2 === 1) {
+      maskData.fill(1, offset, offset + count);
+    }
+    offset += count;
+  }
+  return maskData;
+}
+
 /**
  * API client for the backend segmentation service
  */
@@ -40,6 +62,26 @@ export class ApiService {
     }
   }
 
+  /**
+   * Ask the backend to compute the image embedding ahead of segmentation
+   * @param imageId ID of the uploaded image
+   */
+  static async prepareImage(imageId: string): Promise<void> {
+    try {
+      const response = await fetch(`${API_URL}/api/v1/prepare/${imageId}`, {
+        method: 'POST',
+      });
+
+      if (!response.ok) {
+        const errorData = await response.json();
+        throw new Error(errorData.detail || 'Failed to prepare image');
+      }
+    } catch (error) {
+      console.error('Error preparing image:', error);
+      throw error;
+    }
+  }
+
   /**
    * Segment an image using the backend service
    * @param imageId ID of the image to segment
@@ -52,7 +94,10 @@ export class ApiService {
       points?: number[][];
       point_labels?: number[];
       box?: number[];
-      mode?: 'auto' | 'point' | 'box';
+      mode?: 'auto' | 'point' | 'box' | 'grid';
+      return_top_k?: number;
+      points_per_side?: number;
+      points_per_batch?: number;
     } = {}
   ): Promise<SegmentationResult> {
     try {
@@ -72,11 +117,12 @@ export class ApiService {
       const data = await response.json();
       
       // Map the backend response to the frontend Mask type
+      const maskSize = data.image_width * data.image_height;
       const masks: Mask[] = data.masks.map((mask: any) => ({
         id: mask.id,
         score: mask.score,
         bbox: mask.bbox,
-        maskData: new Uint8Array(mask.mask_data),
+        maskData: decodeRle(mask.rle, maskSize),
       }));
       
       return {
@@ -67,6 +67,9 @@ export default function Home() {
       const result = await ApiService.uploadImage(file);
       setImageId(result.image_id);
       
+      // Start encoding the image in the background so segmentation is fast
+      ApiService.prepareImage(result.image_id).catch(() => {});
+      
       // Keep the local preview URL
       toast.success('Image uploaded successfully! Ready to segment.');
     } catch (error: any) {